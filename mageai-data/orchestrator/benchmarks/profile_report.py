@@ -0,0 +1,145 @@
+"""
+Hotspot report for backfill runs executed with the `profile` runtime variable.
+
+Reads the per-window and per-chunk JSON artifacts written by the fetcher and
+loader blocks (and the optional cProfile captures of `profile_sampler`) and
+aggregates them into a per-phase breakdown, the slowest windows and the top
+functions by cumulative time.
+
+Usage:
+    python benchmarks/profile_report.py /home/src/orchestrator/profiles/qb_invoices_backfill/<run>
+    python benchmarks/profile_report.py <run_dir> --top 30 --output hotspots.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import pstats
+
+# Phases that are a breakdown of another phase (the loader splits upsert_execute into these two)
+SUB_PHASES = {
+    'sql_compile_and_bind': 'upsert_execute',
+    'db_execute': 'upsert_execute',
+}
+# The fetcher's pipelined consumer thread runs alongside extraction; its phases overlap http_wait and rate_limit_wait
+CONCURRENT_PREFIX = 'pipelined_'
+
+
+def load_artifacts(run_dir):
+    artifacts = []
+    for path in sorted(glob.glob(os.path.join(run_dir, '**', '*.json'), recursive=True)):
+        with open(path) as f:
+            artifact = json.load(f)
+        artifact['path'] = path
+        artifacts.append(artifact)
+    return artifacts
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def aggregate_phases(artifacts):
+    # (block, phase, granularity) -> totals across every window or chunk of the run
+    # Percentiles only compare artifacts of the same granularity (per window vs per chunk)
+    phases = {}
+    for artifact in artifacts:
+        per = 'chunk' if artifact.get('window') == 'chunk' else 'window'
+        for name, stats in artifact.get('phases', {}).items():
+            block, within = artifact['block'], SUB_PHASES.get(name, '')
+            if name.startswith(CONCURRENT_PREFIX):
+                # Own block so the overlapping time does not inflate the fetcher total
+                block, within = 'consumer', 'concurrent'
+            entry = phases.setdefault((block, name, per), {'within': within, 'seconds': 0.0, 'count': 0, 'per_artifact': []})
+            entry['seconds'] += stats['seconds']
+            entry['count'] += stats['count']
+            entry['per_artifact'].append(stats['seconds'])
+
+    block_totals = {}
+    for (block, name, per), entry in phases.items():
+        # Sub-phases are already included in their parent phase; do not count them twice
+        if name not in SUB_PHASES:
+            block_totals[block] = block_totals.get(block, 0.0) + entry['seconds']
+
+    rows = []
+    for (block, name, per), entry in phases.items():
+        rows.append({
+            'block': block,
+            'phase': name,
+            'within': entry['within'],
+            'per': per,
+            'seconds': round(entry['seconds'], 3),
+            'share': round(entry['seconds'] / block_totals[block], 3) if block_totals.get(block) else None,
+            'calls': entry['count'],
+            'p50_seconds': round(percentile(entry['per_artifact'], 0.5), 3),
+            'p95_seconds': round(percentile(entry['per_artifact'], 0.95), 3),
+        })
+    return sorted(rows, key=lambda r: (r['block'], -r['seconds']))
+
+
+def slowest_windows(artifacts, top):
+    windows = [a for a in artifacts if a.get('window') != 'chunk']
+    windows.sort(key=lambda a: a.get('duration_seconds', 0), reverse=True)
+    return [{
+        'block': a['block'],
+        'realm_id': a.get('realm_id'),
+        'window': a['window'],
+        'rows': a.get('rows'),
+        'duration_seconds': a.get('duration_seconds'),
+        'rows_per_second': round(a['rows'] / a['duration_seconds'], 1) if a.get('rows') and a.get('duration_seconds') else None,
+    } for a in windows[:top]]
+
+
+def top_functions(run_dir, top):
+    # Merge every cProfile capture of the run (pyinstrument captures are HTML, open them directly)
+    captures = glob.glob(os.path.join(run_dir, '**', '*.prof'), recursive=True)
+    if not captures:
+        return None
+    out = io.StringIO()
+    stats = pstats.Stats(*captures, stream=out)
+    stats.sort_stats('cumulative').print_stats(top)
+    return out.getvalue()
+
+
+def print_table(rows, columns):
+    widths = [max(len(c), *(len(str(r.get(c, ''))) for r in rows)) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print('  '.join(str(r.get(c, '')).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate profile artifacts of a backfill run into a hotspot report.')
+    parser.add_argument('run_dir', help='Profile folder of one run: <profile_dir>/<pipeline_uuid>/<execution_date>.')
+    parser.add_argument('--top', type=int, default=20, help='Slowest windows and functions to list.')
+    parser.add_argument('--output', help='Write the aggregated report as JSON to this path.')
+    args = parser.parse_args()
+
+    artifacts = load_artifacts(args.run_dir)
+    if not artifacts:
+        raise SystemExit(f"No profile artifacts found under {args.run_dir}")
+
+    phases = aggregate_phases(artifacts)
+    windows = slowest_windows(artifacts, args.top)
+    functions = top_functions(args.run_dir, args.top)
+
+    print(f"Profile artifacts: {len(artifacts)}\n")
+    print('Phase breakdown')
+    print_table(phases, ['block', 'phase', 'within', 'per', 'seconds', 'share', 'calls', 'p50_seconds', 'p95_seconds'])
+    print('\nSlowest windows')
+    print_table(windows, ['block', 'realm_id', 'window', 'rows', 'duration_seconds', 'rows_per_second'])
+    if functions:
+        print('\nTop functions (cProfile, cumulative)')
+        print(functions)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'phases': phases, 'slowest_windows': windows, 'top_functions': functions}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Table, Column, String, Integer, DateTime, MetaData
+from sqlalchemy import create_engine, Table, Column, String, Text, Integer, DateTime, MetaData
 from sqlalchemy.dialects.postgresql import JSONB, insert
 from pandas import DataFrame
 import time
 from mage_ai.data_preparation.shared.secrets import get_secret_value
+from orchestrator.utils.profiling import PhaseTimer, attach_db_timer, get_profile_dir, write_profile_artifact, start_sampler, stop_sampler
 
 if 'data_exporter' not in globals():
     from mage_ai.data_preparation.decorators import data_exporter
@@ -14,6 +15,10 @@ def export_data(df: DataFrame, **kwargs):
     # Logging: Initialize logger
     logger = kwargs.get('logger')
     
+    if str(kwargs.get('pipelined_load', False)).lower() in ('1', 'true', 'yes'):
+        logger.info("Load: Pipelined mode enabled. Rows were already upserted by the fetcher. Skipping export phase.")
+        return
+
     if df.empty:
         logger.warning("Load: DataFrame is empty. Skipping export phase.")
         return
@@ -23,8 +28,17 @@ def export_data(df: DataFrame, **kwargs):
     # Configuration variables
     table_name = 'qb_items'
     schema = 'raw'
+    # fast_json: the fetcher already serialized each payload, pass the JSON text through untouched
+    fast_json = str(kwargs.get('fast_json', False)).lower() in ('1', 'true', 'yes')
+    # Profiling mode: phase timers per window, optional sampling profiler per child
+    profile = str(kwargs.get('profile', False)).lower() in ('1', 'true', 'yes')
+    profile_sampler = profile and str(kwargs.get('profile_sampler', False)).lower() in ('1', 'true', 'yes')
+    timer = PhaseTimer(profile)
+    profile_dir = get_profile_dir(kwargs) if profile else None
+    profile_name = f"item_load_{df['realm_id'].iloc[0]}_{df['extract_window_start_utc'].iloc[0]}_chunk"
     
     # Phase: Database Connection
+    db_connect_start = time.perf_counter()
     try:
         pg_password = get_secret_value('POSTGRES_PASSWORD')
         pg_user = get_secret_value('POSTGRES_USER')
@@ -38,11 +52,15 @@ def export_data(df: DataFrame, **kwargs):
     except Exception as e:
         logger.error(f"Load: DB Connection failed. Error: {str(e)}")
         raise
+    timer.add('db_connect', time.perf_counter() - db_connect_start)
+    if profile:
+        attach_db_timer(engine, timer)
 
     # Table structure
     table = Table(table_name, metadata,
+        Column('realm_id', String, primary_key=True),
         Column('id', String, primary_key=True),
-        Column('payload', JSONB),
+        Column('payload', Text if fast_json else JSONB),
         Column('ingested_at_utc', DateTime),
         Column('extract_window_start_utc', DateTime),
         Column('extract_window_end_utc', DateTime),
@@ -51,41 +69,94 @@ def export_data(df: DataFrame, **kwargs):
     )
 
     # Phase: Load (Upsert)
-    records = df.to_dict(orient='records')
-    row_count = 0
-    input_count = len(records)
-    
-    logger.info(f"Load: Starting Batch Upsert for {input_count} records...")
-    
+    # One transaction per extraction window so each window keeps its own result and validation
+    total_upserted = 0
+    total_input = 0
+
+    # Chunk-level phases (connection) are reported separately from the per-window ones
+    chunk_phases = timer.snapshot()
+
+    sampler = start_sampler(profile_sampler)
+    sampler_path = None
     try:
-        with engine.begin() as conn:
-            stmt = insert(table).values(records)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=['id'],
-                set_={
-                    'payload': stmt.excluded.payload,
-                    'ingested_at_utc': stmt.excluded.ingested_at_utc,
-                    'extract_window_start_utc': stmt.excluded.extract_window_start_utc,
-                    'extract_window_end_utc': stmt.excluded.extract_window_end_utc,
-                    'page_number': stmt.excluded.page_number
-                }
-            )
-            result = conn.execute(stmt)
-            row_count = result.rowcount 
-            
-    except Exception as e:
-        logger.error(f"Load: Transaction failed. Error: {str(e)}")
-        raise
-    
-    # Validation
-    # Ensure Input vs Output logic holds. 
-    if input_count > 0 and row_count == 0:
-        msg = f"Validation: Critical Integrity Error. Input {input_count} rows, but DB reported 0 rows affected."
-        logger.error(msg)
-        raise Exception(msg)
-    
-    logger.info(f"Validation: Integrity Check Passed. Input: {input_count} | Output (rows affected): {row_count}")
+        for (realm_id, window_start), window_df in df.groupby(['realm_id', 'extract_window_start_utc'], sort=False):
+            window_start_time = time.time()
+            with timer.phase('to_dict'):
+                records = window_df.to_dict(orient='records')
+            row_count = 0
+            input_count = len(records)
+        
+            logger.info(f"Load: Starting Batch Upsert for {input_count} records (realm {realm_id}, window {window_start})...")
+        
+            try:
+                with engine.begin() as conn:
+                    with timer.phase('statement_build'):
+                        stmt = insert(table).values(records)
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=['realm_id', 'id'],
+                            set_={
+                                'payload': stmt.excluded.payload,
+                                'ingested_at_utc': stmt.excluded.ingested_at_utc,
+                                'extract_window_start_utc': stmt.excluded.extract_window_start_utc,
+                                'extract_window_end_utc': stmt.excluded.extract_window_end_utc,
+                                'page_number': stmt.excluded.page_number
+                            }
+                        )
+                    with timer.phase('upsert_execute'):
+                        result = conn.execute(stmt)
+                    row_count = result.rowcount 
+                
+            except Exception as e:
+                logger.error(f"Load: Transaction failed for realm {realm_id}, window {window_start}. Error: {str(e)}")
+                raise
+        
+            # Validation
+            # Ensure Input vs Output logic holds. 
+            if input_count > 0 and row_count == 0:
+                msg = f"Validation: Critical Integrity Error. Input {input_count} rows, but DB reported 0 rows affected (realm {realm_id}, window {window_start})."
+                logger.error(msg)
+                raise Exception(msg)
+        
+            logger.info(f"Validation: Integrity Check Passed. Input: {input_count} | Output (rows affected): {row_count}")
+
+            duration = time.time() - window_start_time
+            logger.info(f"--- Load Summary: realm {realm_id}, window {window_start} ---")
+            logger.info(f"Metrics: {{'rows_upserted': {row_count}, 'rows_input': {input_count}, 'duration_seconds': {duration:.2f}}}")
+
+            if profile:
+                # conn.execute = SQL compilation + parameter binding (JSON encoding) + database round trip
+                timer.add('sql_compile_and_bind', max(0.0, timer.total('upsert_execute') - timer.total('db_execute')))
+                path = write_profile_artifact(profile_dir, f"item_load_{realm_id}_{window_start}", {
+                    'block': 'loader',
+                    'entity': 'Item',
+                    'realm_id': realm_id,
+                    'window': str(window_start),
+                    'rows': input_count,
+                    'duration_seconds': round(duration, 6),
+                    'phases': timer.snapshot()
+                })
+                logger.info(f"Profile: Window profile written to {path}")
+
+            total_upserted += row_count
+            total_input += input_count
+    finally:
+        # Always stop the sampler, a failed child keeps its capture for inspection
+        if profile_sampler:
+            sampler_path = stop_sampler(sampler, profile_dir, profile_name)
+
+    engine.dispose()
 
     duration = time.time() - start_time
     logger.info(f"--- Load Summary ---")
-    logger.info(f"Metrics: {{'rows_upserted': {row_count}, 'rows_input': {input_count}, 'duration_seconds': {duration:.2f}}}")
\ No newline at end of file
+    logger.info(f"Metrics: {{'rows_upserted': {total_upserted}, 'rows_input': {total_input}, 'duration_seconds': {duration:.2f}}}")
+
+    if profile:
+        path = write_profile_artifact(profile_dir, profile_name, {
+            'block': 'loader',
+            'entity': 'Item',
+            'window': 'chunk',
+            'duration_seconds': round(duration, 6),
+            'phases': chunk_phases,
+            'sampler': sampler_path
+        })
+        logger.info(f"Profile: Chunk profile written to {path}")
\ No newline at end of file
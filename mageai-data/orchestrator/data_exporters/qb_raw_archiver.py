@@ -0,0 +1,140 @@
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, text
+from mage_ai.data_preparation.shared.secrets import get_secret_value
+
+if 'data_exporter' not in globals():
+    from mage_ai.data_preparation.decorators import data_exporter
+
+DEFAULT_ARCHIVE_DIR = '/home/src/orchestrator/archive'
+
+# Archiver (Dynamic Child): moves aged raw rows into Parquet partitioned by entity and month
+
+@data_exporter
+def archive_entity(chunk_data, **kwargs):
+    # Logging: Initialize logger
+    logger = kwargs.get('logger')
+
+    start_time = time.time()
+    entity = chunk_data['entity']
+    table_name = chunk_data['table_name']
+    schema = 'raw'
+
+    # Configuration variables
+    archive_dir = kwargs.get('archive_dir', DEFAULT_ARCHIVE_DIR)
+    batch_size = int(kwargs.get('archive_batch_size', 50000))
+    vacuum = str(kwargs.get('archive_vacuum', True)).lower() in ('1', 'true', 'yes')
+    # Rows are aged by the extraction window (record's LastUpdatedTime day), not by ingestion time
+    cutoff = (datetime.utcnow() - timedelta(days=chunk_data['horizon_days'])).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    logger.info(f"--- Starting Archive: {schema}.{table_name} (rows with window before {cutoff:%Y-%m-%d}) ---")
+
+    # Phase: Database Connection
+    try:
+        pg_password = get_secret_value('POSTGRES_PASSWORD')
+        pg_user = get_secret_value('POSTGRES_USER')
+        pg_db = get_secret_value('POSTGRES_DB')
+        pg_host = get_secret_value('POSTGRES_HOST')
+        pg_port = get_secret_value('POSTGRES_PORT')
+        db_url = f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}/{pg_db}"
+
+        engine = create_engine(db_url)
+    except Exception as e:
+        logger.error(f"Archive: DB Connection failed. Error: {str(e)}")
+        raise
+
+    # Without this index every batch below would scan the whole table (the only index is the (realm_id, id) key)
+    index_name = f"{table_name}_extract_window_start_idx"
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {schema}.{table_name} (extract_window_start_utc)"))
+
+    with engine.connect() as conn:
+        months = [row[0] for row in conn.execute(text(
+            f"SELECT DISTINCT date_trunc('month', extract_window_start_utc) FROM {schema}.{table_name} "
+            "WHERE extract_window_start_utc < :cutoff ORDER BY 1"
+        ), {'cutoff': cutoff})]
+
+    if not months:
+        logger.info(f"Archive: No rows older than {cutoff:%Y-%m-%d} in {schema}.{table_name}. Nothing to do.")
+        return
+
+    select_batch = text(
+        f"SELECT realm_id, id, payload::text AS payload, payload->>'SyncToken' AS sync_token, ingested_at_utc, "
+        "extract_window_start_utc, extract_window_end_utc, page_number, request_payload::text AS request_payload "
+        f"FROM {schema}.{table_name} "
+        "WHERE extract_window_start_utc >= :month_start AND extract_window_start_utc < :month_end "
+        "ORDER BY extract_window_start_utc LIMIT :batch_size FOR UPDATE"
+    )
+    delete_batch = text(
+        f"DELETE FROM {schema}.{table_name} "
+        "WHERE (realm_id, id) IN (SELECT * FROM unnest(CAST(:realm_ids AS varchar[]), CAST(:ids AS varchar[])))"
+    )
+
+    total_archived = 0
+    run_stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+    for month_start in months:
+        month_end = min((month_start + timedelta(days=32)).replace(day=1), cutoff)
+        partition_dir = os.path.join(archive_dir, f"entity={entity}", f"month={month_start:%Y-%m}")
+        os.makedirs(partition_dir, exist_ok=True)
+        part = 0
+        month_count = 0
+
+        while True:
+            # Phase: Move one batch (write Parquet, then delete in the same transaction)
+            # A failure after writing the file leaves a duplicate in the archive, never a lost row
+            with engine.begin() as conn:
+                df = pd.read_sql(select_batch, conn, params={
+                    'month_start': month_start,
+                    'month_end': month_end,
+                    'batch_size': batch_size
+                })
+                if df.empty:
+                    break
+
+                part += 1
+                df['archived_at_utc'] = datetime.utcnow()
+                path = os.path.join(partition_dir, f"part-{run_stamp}-{part:05d}.parquet")
+                try:
+                    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, compression='zstd')
+                    result = conn.execute(delete_batch, {
+                        'realm_ids': df['realm_id'].tolist(),
+                        'ids': df['id'].tolist()
+                    })
+
+                    # Validation
+                    if result.rowcount != len(df):
+                        msg = f"Validation: Critical Integrity Error. Archived {len(df)} rows, but deleted {result.rowcount} from {schema}.{table_name}."
+                        logger.error(msg)
+                        raise Exception(msg)
+                except Exception as e:
+                    # The transaction rolls back, so the part file must go too or every rerun duplicates it
+                    logger.error(f"Archive: Failed to move batch {part} of {month_start:%Y-%m}. Error: {str(e)}")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    raise
+
+            month_count += len(df)
+            logger.info(f"Archive: {entity} {month_start:%Y-%m} part {part} -> {len(df)} rows ({path}).")
+
+            if len(df) < batch_size:
+                break
+
+        total_archived += month_count
+        logger.info(f"Archive: {entity} {month_start:%Y-%m} done. Rows archived: {month_count}")
+
+    # Reclaim the space of deleted rows so the hot table stays small
+    if vacuum and total_archived > 0:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text(f"VACUUM (ANALYZE) {schema}.{table_name}"))
+        logger.info(f"Archive: VACUUM (ANALYZE) completed on {schema}.{table_name}.")
+
+    engine.dispose()
+
+    duration = time.time() - start_time
+    logger.info(f"--- Archive Summary: {schema}.{table_name} ---")
+    logger.info(f"Metrics: {{'months': {len(months)}, 'rows_archived': {total_archived}, 'duration_seconds': {duration:.2f}}}")
@@ -0,0 +1,36 @@
+if 'data_loader' not in globals():
+    from mage_ai.data_preparation.decorators import data_loader
+
+# Raw tables eligible for archiving (entity -> table in schema raw)
+ENTITY_TABLES = {
+    'invoice': 'qb_invoices',
+    'customer': 'qb_customers',
+    'item': 'qb_items',
+}
+
+
+# Archive planner (one dynamic child per entity)
+@data_loader
+def plan_archive(*args, **kwargs):
+    # Configuration variables (from trigger)
+    entities = kwargs.get('archive_entities') or list(ENTITY_TABLES)
+    if isinstance(entities, str):
+        entities = [e.strip() for e in entities.split(',') if e.strip()]
+    horizon_days = int(kwargs.get('archive_horizon_days', 365))
+
+    chunks = []
+    metadata = []
+
+    for entity in entities:
+        # Data payload for the downstream child
+        chunks.append({
+            'entity': entity,
+            'table_name': ENTITY_TABLES[entity],
+            'horizon_days': horizon_days
+        })
+
+        # Metadata to identify the child run in Mage UI
+        metadata.append({'block_uuid': f"archive_{ENTITY_TABLES[entity]}"})
+
+    # Return format for Mage Dynamic Blocks: [data_list, metadata_list]
+    return [chunks, metadata]
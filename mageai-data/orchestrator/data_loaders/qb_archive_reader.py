@@ -0,0 +1,72 @@
+import json
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+
+if 'data_loader' not in globals():
+    from mage_ai.data_preparation.decorators import data_loader
+
+DEFAULT_ARCHIVE_DIR = '/home/src/orchestrator/archive'
+
+
+def read_archive(entity, archive_dir=DEFAULT_ARCHIVE_DIR, month_from=None, month_to=None, realm_id=None, ids=None, latest_only=True):
+    # Cold read path: only the entity/month partitions in range are scanned
+    path = os.path.join(archive_dir, f"entity={entity}")
+    if not os.path.isdir(path):
+        return pd.DataFrame()
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    filters = []
+    if month_from:
+        filters.append(ds.field('month') >= month_from)
+    if month_to:
+        filters.append(ds.field('month') <= month_to)
+    if realm_id:
+        filters.append(ds.field('realm_id') == realm_id)
+    if ids:
+        filters.append(ds.field('id').isin(ids))
+
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    df = dataset.to_table(filter=expression).to_pandas()
+
+    # The archive may hold several versions of a record (re-archived after a newer SyncToken was loaded)
+    if latest_only and not df.empty:
+        df['_sync_token'] = pd.to_numeric(df['sync_token'], errors='coerce')
+        df = (df.sort_values(['_sync_token', 'archived_at_utc'])
+                .drop_duplicates(subset=['realm_id', 'id'], keep='last')
+                .drop(columns='_sync_token')
+                .reset_index(drop=True))
+    return df
+
+
+# Archive reader (Parquet cold storage)
+@data_loader
+def load_archive(*args, **kwargs):
+    # Logging: Initialize logger
+    logger = kwargs.get('logger')
+
+    # Configuration variables (from trigger)
+    entity = kwargs.get('entity', 'invoice')
+    ids = kwargs.get('ids')
+    if isinstance(ids, str):
+        ids = [i.strip() for i in ids.split(',') if i.strip()]
+    latest_only = str(kwargs.get('latest_only', True)).lower() in ('1', 'true', 'yes')
+
+    df = read_archive(
+        entity,
+        archive_dir=kwargs.get('archive_dir', DEFAULT_ARCHIVE_DIR),
+        month_from=kwargs.get('month_from'),
+        month_to=kwargs.get('month_to'),
+        realm_id=kwargs.get('realm_id'),
+        ids=ids,
+        latest_only=latest_only
+    )
+
+    # payload back as JSON objects; the frame also carries month, sync_token and archived_at_utc, and request_payload stays as text
+    if not df.empty:
+        df['payload'] = df['payload'].map(json.loads)
+
+    logger.info(f"Archive: Read {len(df)} {entity} rows from cold storage (months {kwargs.get('month_from')}..{kwargs.get('month_to')}).")
+    return df
@@ -1,37 +1,282 @@
+import json
+import math
 import pandas as pd
+import requests
 from typing import Dict, List
+from sqlalchemy import create_engine, text
+from mage_ai.data_preparation.shared.secrets import get_secret_value
+from orchestrator.utils.qbo_api import DEFAULT_REQUESTS_PER_MINUTE, get_auth_headers, wait_for_realm_budget
 
 if 'data_loader' not in globals():
     from mage_ai.data_preparation.decorators import data_loader
 
+# Dry-run planner defaults (overridable from the trigger)
+ENTITY = "Customer"
+TABLE_NAME = 'qb_customers'
+MAX_RESULTS = 1000
+QBO_MAX_CONCURRENT_PER_REALM = 10
 
-# Data chunker (by days)
+
+def get_realm_ids(kwargs) -> List[str]:
+    # Realm list: trigger variable 'realm_ids', then secret QBO_REALM_IDS, then the single QBO_REALM_ID
+    realms = kwargs.get('realm_ids') or get_secret_value('QBO_REALM_IDS') or get_secret_value('QBO_REALM_ID')
+    if isinstance(realms, str):
+        realms = realms.split(',')
+    return [str(r).strip() for r in realms if str(r).strip()]
+
+
+def count_requests(records):
+    # Mirrors the fetcher loop: full pages continue, a short (or empty) page stops
+    return records // MAX_RESULTS + 1
+
+
+def probe_window_counts(realm_ids, windows, requests_per_minute, logger):
+    # COUNT(*) probe per realm/window against QBO (one cheap request per window)
+    counts = {}
+    base_url = "https://sandbox-quickbooks.api.intuit.com" if get_secret_value('QBO_ENTORNO') == 'sandbox' else "https://quickbooks.api.intuit.com"
+    for realm_id in realm_ids:
+        headers = get_auth_headers(logger, realm_id)
+
+        with requests.Session() as session:
+            for window in windows:
+                query = f"SELECT COUNT(*) FROM {ENTITY} WHERE MetaData.LastUpdatedTime >= '{window['q_start']}' AND MetaData.LastUpdatedTime < '{window['q_end']}'"
+                url = f"{base_url}/v3/company/{realm_id}/query?query={query}"
+                # Same per-realm budget as the fetchers, so a dry run during a live backfill shares its limit
+                backoff = 0
+                for i in range(6):
+                    wait_for_realm_budget(realm_id, requests_per_minute, backoff)
+                    resp = session.get(url, headers=headers)
+                    if resp.status_code != 429:
+                        break
+                    backoff = 2 ** (i + 1)
+                    logger.warning(f"API Limit: 429 Too Many Requests for realm {realm_id}. Retry {i+1}/6 in {backoff}s.")
+                resp.raise_for_status()
+                counts[(realm_id, window['q_start'])] = int(resp.json().get('QueryResponse', {}).get('totalCount', 0))
+    return counts
+
+
+def history_window_counts(realm_ids, windows, logger):
+    # Rows already in raw per realm/day; days without history are estimated with the realm's daily mean
+    pg_password = get_secret_value('POSTGRES_PASSWORD')
+    pg_user = get_secret_value('POSTGRES_USER')
+    pg_db = get_secret_value('POSTGRES_DB')
+    pg_host = get_secret_value('POSTGRES_HOST')
+    pg_port = get_secret_value('POSTGRES_PORT')
+    engine = create_engine(f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}/{pg_db}")
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT realm_id, to_char(extract_window_start_utc, 'YYYY-MM-DD'), COUNT(*) "
+            f"FROM raw.{TABLE_NAME} WHERE realm_id = ANY(:realm_ids) "
+            "AND extract_window_start_utc >= :start AND extract_window_start_utc < :end GROUP BY 1, 2"
+        ), {'realm_ids': realm_ids, 'start': windows[0]['q_start'], 'end': windows[-1]['q_end']}).fetchall()
+    engine.dispose()
+
+    observed = {(realm_id, day): count for realm_id, day, count in rows}
+    counts = {}
+    estimated = 0
+    for realm_id in realm_ids:
+        realm_counts = [c for (r, _), c in observed.items() if r == realm_id]
+        mean = round(sum(realm_counts) / len(realm_counts)) if realm_counts else 0
+        for window in windows:
+            key = (realm_id, window['q_start'])
+            if key not in observed:
+                estimated += 1
+            counts[key] = observed.get(key, mean)
+    if estimated:
+        logger.warning(f"Dry Run: {estimated} realm/day windows have no history in raw.{TABLE_NAME}; using each realm's daily mean.")
+    return counts
+
+
+def plan_backfill(realm_ids, windows, windows_per_child, kwargs, logger):
+    # Dry run: estimate requests, child runs and wall time for the trigger, and suggest a window plan
+    source = kwargs.get('dry_run_source', 'probe')
+    requests_per_minute = int(kwargs.get('qbo_requests_per_minute', DEFAULT_REQUESTS_PER_MINUTE))
+    concurrency = max(1, int(kwargs.get('dry_run_concurrency', 4)))
+    seconds_per_request = float(kwargs.get('dry_run_seconds_per_request', 1.5))
+    seconds_per_1k_rows = float(kwargs.get('dry_run_seconds_per_1k_rows', 2.0))
+    child_overhead_seconds = float(kwargs.get('dry_run_child_overhead_seconds', 8.0))
+    target_rows_per_child = int(kwargs.get('dry_run_target_rows_per_child', 5000))
+    daily_quota = kwargs.get('qbo_daily_request_quota')
+
+    if not windows:
+        logger.warning("Dry Run: Empty date range. Nothing to plan.")
+        return {}
+
+    if source == 'history':
+        counts = history_window_counts(realm_ids, windows, logger)
+    else:
+        counts = probe_window_counts(realm_ids, windows, requests_per_minute, logger)
+
+    per_window = [
+        {'realm_id': realm_id, 'q_start': w['q_start'], 'records': counts[(realm_id, w['q_start'])], 'requests': count_requests(counts[(realm_id, w['q_start'])])}
+        for w in windows for realm_id in realm_ids
+    ]
+    children = math.ceil(len(windows) / windows_per_child) * len(realm_ids)
+    total_records = sum(w['records'] for w in per_window)
+    total_requests = sum(w['requests'] for w in per_window)
+    requests_by_realm = {r: sum(w['requests'] for w in per_window if w['realm_id'] == r) for r in realm_ids}
+
+    # Wall time: the slowest of the work spread over the concurrent children, the longest single child
+    # and the per-realm rate limit
+    def work_seconds(child_runs):
+        return child_runs * child_overhead_seconds + total_requests * seconds_per_request + total_records / 1000 * seconds_per_1k_rows
+
+    def child_groups(group_size):
+        # Same grouping as generate_chunks: consecutive days of one realm per child
+        groups = []
+        for realm_id in realm_ids:
+            realm_windows = [w for w in per_window if w['realm_id'] == realm_id]
+            groups.extend(realm_windows[i:i + group_size] for i in range(0, len(realm_windows), group_size))
+        return groups
+
+    def longest_child_seconds(group_size):
+        return max(child_overhead_seconds
+                   + sum(w['requests'] for w in group) * seconds_per_request
+                   + sum(w['records'] for w in group) / 1000 * seconds_per_1k_rows
+                   for group in child_groups(group_size))
+
+    def heavy_groups(group_size):
+        # Multi-day children over the target (single heavy days are reported as heavy_windows)
+        return [
+            f"{group[0]['realm_id']} {group[0]['q_start']}..{group[-1]['q_start']} ({sum(w['records'] for w in group)} records over {len(group)} days)"
+            for group in child_groups(group_size)
+            if len(group) > 1 and sum(w['records'] for w in group) > target_rows_per_child
+        ]
+
+    def wall_seconds(child_runs, group_size, parallel):
+        # More parallel slots than children do not help
+        parallel = min(parallel, child_runs)
+        return max(work_seconds(child_runs) / parallel, longest_child_seconds(group_size), rate_bound_seconds)
+
+    rate_bound_seconds = max(requests_by_realm.values()) / requests_per_minute * 60
+    projected_seconds = wall_seconds(children, windows_per_child, concurrency)
+
+    # Suggested plan: group days so each child handles about target_rows_per_child records,
+    # and only as much concurrency as helps (never more than the child runs; QBO allows 10 concurrent requests per realm)
+    # windows_per_child applies to every realm, so it is sized from the heaviest realm's daily mean
+    mean_records = max(sum(w['records'] for w in per_window if w['realm_id'] == r) for r in realm_ids) / len(windows)
+    suggested_windows_per_child = max(1, min(len(windows), int(target_rows_per_child // mean_records) if mean_records else len(windows)))
+    suggested_children = math.ceil(len(windows) / suggested_windows_per_child) * len(realm_ids)
+    # Beyond this, the rate limit or the longest child sets the wall time and extra slots sit idle
+    floor_seconds = max(rate_bound_seconds, longest_child_seconds(suggested_windows_per_child))
+    ideal_concurrency = math.ceil(work_seconds(suggested_children) / floor_seconds) if floor_seconds else concurrency
+    suggested_concurrency = max(1, min(ideal_concurrency, suggested_children, QBO_MAX_CONCURRENT_PER_REALM * len(realm_ids)))
+    suggested_seconds = wall_seconds(suggested_children, suggested_windows_per_child, suggested_concurrency)
+    heavy_windows = [w for w in per_window if w['records'] > target_rows_per_child]
+
+    plan = {
+        'entity': ENTITY,
+        'source': source,
+        'realms': len(realm_ids),
+        'windows': len(windows),
+        'windows_per_child': windows_per_child,
+        'child_runs': children,
+        'total_records': total_records,
+        'total_api_requests': total_requests,
+        'auth_requests': children,
+        'api_requests_by_realm': requests_by_realm,
+        'heavy_groups': heavy_groups(windows_per_child),
+        'projected_wall_time_hours': round(projected_seconds / 3600, 2),
+        'projected_wall_time_minutes': round(projected_seconds / 60, 1),
+        'longest_child_minutes': round(longest_child_seconds(windows_per_child) / 60, 1),
+        'rate_limit_bound_hours': round(rate_bound_seconds / 3600, 2),
+        'assumptions': {
+            'concurrency': concurrency,
+            'requests_per_minute_per_realm': requests_per_minute,
+            'seconds_per_request': seconds_per_request,
+            'seconds_per_1k_rows': seconds_per_1k_rows,
+            'child_overhead_seconds': child_overhead_seconds
+        },
+        'suggestion': {
+            'windows_per_child': suggested_windows_per_child,
+            'child_runs': suggested_children,
+            'concurrency': suggested_concurrency,
+            'projected_wall_time_hours': round(suggested_seconds / 3600, 2),
+            'projected_wall_time_minutes': round(suggested_seconds / 60, 1),
+            'heavy_windows': [f"{w['realm_id']} {w['q_start']} ({w['records']} records)" for w in heavy_windows],
+            'heavy_groups': heavy_groups(suggested_windows_per_child)
+        },
+        'per_window': per_window
+    }
+
+    if daily_quota:
+        days_needed = max(requests_by_realm.values()) / int(daily_quota)
+        plan['daily_quota'] = int(daily_quota)
+        plan['fits_daily_quota'] = days_needed <= 1
+        plan['suggestion']['days_to_split_over'] = math.ceil(days_needed)
+
+    # Report
+    logger.info(f"--- Dry Run Plan: {ENTITY} {windows[0]['q_start']} -> {windows[-1]['q_end']} ({source}) ---")
+    for w in per_window:
+        logger.info(f"Dry Run: realm {w['realm_id']} {w['q_start']} -> {w['records']} records, {w['requests']} requests")
+    logger.info(f"Metrics: {{'child_runs': {children}, 'total_records': {total_records}, 'total_api_requests': {total_requests}, 'projected_wall_time_minutes': {plan['projected_wall_time_minutes']}}}")
+    if 'fits_daily_quota' in plan and not plan['fits_daily_quota']:
+        logger.warning(f"Dry Run: [ALERT] {max(requests_by_realm.values())} requests for one realm exceed the daily quota of {daily_quota}. Split the range over {plan['suggestion']['days_to_split_over']} days.")
+    logger.info(f"Dry Run: Suggested windows_per_child={suggested_windows_per_child} ({suggested_children} child runs), concurrency={suggested_concurrency} -> {plan['suggestion']['projected_wall_time_minutes']} minutes.")
+    if plan['heavy_groups']:
+        logger.warning(f"Dry Run: [ALERT] With windows_per_child={windows_per_child}, {len(plan['heavy_groups'])} child runs exceed {target_rows_per_child} records (see heavy_groups).")
+    for heavy in plan['suggestion']['heavy_windows']:
+        logger.warning(f"Dry Run: Heavy window {heavy}; keep it alone in its child or use pipelined_load.")
+    for heavy in plan['suggestion']['heavy_groups']:
+        logger.warning(f"Dry Run: Heavy child {heavy} under the suggested plan; lower windows_per_child or run that range separately.")
+
+    if kwargs.get('dry_run_output'):
+        with open(kwargs['dry_run_output'], 'w') as f:
+            json.dump(plan, f, indent=2)
+        logger.info(f"Dry Run: Plan written to {kwargs['dry_run_output']}")
+
+    return plan
+
+
+# Data chunker (by realm x days, grouped N windows per child)
 @data_loader
 def generate_chunks(*args, **kwargs):
     # Configuration variables (from trigger)
     start_str = kwargs.get('fecha_inicio', '2025-09-01')
     end_str = kwargs.get('fecha_fin', '2026-02-01')
-    
+    realm_ids = get_realm_ids(kwargs)
+    # Micro-batching: several daily windows share one child (auth, session, engine, output persistence)
+    windows_per_child = max(1, int(kwargs.get('windows_per_child', 1)))
+
     # Chunking: split the range into daily intervals
     dates = pd.date_range(start=start_str, end=end_str, freq='D')
-    
+    windows = [
+        {
+            'q_start': dates[i].strftime('%Y-%m-%d'),
+            'q_end': dates[i+1].strftime('%Y-%m-%d'),
+            'index': i + 1
+        }
+        for i in range(len(dates) - 1)
+    ]
+
+    # Dry run: report the estimated cost and window plan without launching any child
+    if str(kwargs.get('dry_run', False)).lower() in ('1', 'true', 'yes'):
+        plan_backfill(realm_ids, windows, windows_per_child, kwargs, kwargs.get('logger'))
+        return [[], []]
+
+    groups = [windows[i:i + windows_per_child] for i in range(0, len(windows), windows_per_child)]
+    total = len(groups) * len(realm_ids)
+
     chunks = []
     metadata = []
-    
-    for i in range(len(dates) - 1):
-        q_start = dates[i].strftime('%Y-%m-%d')
-        q_end = dates[i+1].strftime('%Y-%m-%d')
-        
-        # Data payload for the downstream child
-        chunks.append({
-            'q_start': q_start,
-            'q_end': q_end,
-            'index': i + 1,
-            'total': len(dates) - 1
-        })
-        
-        # Metadata to identify the child run in Mage UI
-        metadata.append({'block_uuid': f"customer_backfill_{q_start}"})
-    
+
+    # Fair scheduling: interleave realms round-robin so one company cannot starve the others
+    for group in groups:
+        for realm_id in realm_ids:
+            # Data payload for the downstream child
+            chunks.append({
+                'realm_id': realm_id,
+                'windows': group,
+                'index': len(chunks) + 1,
+                'total': total
+            })
+
+            # Metadata to identify the child run in Mage UI
+            block_uuid = f"customer_backfill_{realm_id}_{group[0]['q_start']}"
+            if len(group) > 1:
+                block_uuid += f"_{group[-1]['q_start']}"
+            metadata.append({'block_uuid': block_uuid})
+
     # Return format for Mage Dynamic Blocks: [data_list, metadata_list]
     return [chunks, metadata]
\ No newline at end of file
@@ -1,39 +1,46 @@
+import json
 import pandas as pd
+import queue
 import requests
 import time
+import threading
 from datetime import datetime
+from sqlalchemy import create_engine, Table, Column, String, Text, Integer, DateTime, MetaData
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from mage_ai.data_preparation.shared.secrets import get_secret_value
+from orchestrator.utils.qbo_api import DEFAULT_REQUESTS_PER_MINUTE, get_auth_headers, wait_for_realm_budget
+from orchestrator.utils.profiling import PhaseTimer, get_profile_dir, write_profile_artifact, start_sampler, stop_sampler
 
 if 'data_loader' not in globals():
     from mage_ai.data_preparation.decorators import data_loader
 
+# Optional fast JSON decoders (fast_json mode); the standard library is the fallback
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Pipelined mode (fetch and upsert overlap): raw table written directly by this block
+TABLE_NAME = 'qb_invoices'
+SCHEMA = 'raw'
+
 # Auxiliar functions with Logging
 
-def get_auth_headers(logger):
-    # Phase: Auth
-    logger.info("Auth: Requesting new access token via Refresh Token...")
-    try:
-        url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
-        payload = {
-            'grant_type': 'refresh_token',
-            'refresh_token': get_secret_value('QBO_REFRESH_TOKEN')
-        }
-        auth = (get_secret_value('QBO_CLIENT_ID'), get_secret_value('QBO_CLIENT_SECRET'))
-        resp = requests.post(url, data=payload, auth=auth)
-        resp.raise_for_status()
-        logger.info("Auth: Access token obtained successfully.")
-        return {'Authorization': f'Bearer {resp.json()["access_token"]}', 'Accept': 'application/json'}
-    except Exception as e:
-        logger.error(f"Auth: Failed to retrieve token. Error: {str(e)}")
-        raise
-
-def fetch_with_retry(url, headers, logger, retries=6):
+def fetch_with_retry(session, url, headers, logger, realm_id, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, raw=False, timer=None, retries=6):
+    timer = timer or PhaseTimer()
+    backoff = 0
     for i in range(retries):
-        resp = requests.get(url, headers=headers)
+        with timer.phase('rate_limit_wait'):
+            wait_for_realm_budget(realm_id, requests_per_minute, backoff)
+        with timer.phase('http_wait'):
+            resp = session.get(url, headers=headers)
         if resp.status_code == 429:
-            wait_time = 2 ** (i + 1)
-            logger.warning(f"API Limit: 429 Too Many Requests. Retry {i+1}/{retries} in {wait_time}s.")
-            time.sleep(wait_time) 
+            backoff = 2 ** (i + 1)
+            logger.warning(f"API Limit: 429 Too Many Requests for realm {realm_id}. Retry {i+1}/{retries} in {backoff}s.")
             continue
         
         try:
@@ -42,11 +49,199 @@ def fetch_with_retry(url, headers, logger, retries=6):
             logger.error(f"Extraction: HTTP Error {resp.status_code} for URL {url}")
             raise e
             
-        return resp.json()
+        # raw: hand back the undecoded body for the fast_json path
+        if raw:
+            return resp.content
+        with timer.phase('json_parse'):
+            return resp.json()
     
     logger.error("Extraction: Circuit Breaker - Max retries exceeded.")
     raise Exception("Max retries exceeded")
 
+def decode_page(content, entity):
+    # fast_json: returns (Id, raw JSON text) per record without rebuilding Python dicts for the payload
+    if simdjson is not None:
+        doc = simdjson.Parser().parse(content)
+        try:
+            items = doc.at_pointer(f'/QueryResponse/{entity}')
+        except (KeyError, ValueError):
+            return []
+        # .mini is bytes in pysimdjson; the payload must bind as text, a bytea parameter is rejected by the JSONB column
+        return [(item['Id'], item.mini.decode()) for item in items]
+
+    if orjson is not None:
+        items = orjson.loads(content).get('QueryResponse', {}).get(entity, [])
+        return [(item['Id'], orjson.dumps(item).decode()) for item in items]
+
+    items = json.loads(content).get('QueryResponse', {}).get(entity, [])
+    return [(item['Id'], json.dumps(item, separators=(',', ':'))) for item in items]
+
+def fetch_window_pages(session, base_url, realm_id, headers, window, logger, requests_per_minute, entity, fast_json=False, timer=None):
+    # Extract one daily window, yielding the records of each page as soon as it arrives
+    timer = timer or PhaseTimer()
+    q_start = window['q_start']
+    q_end = window['q_end']
+
+    start_pos = 1
+    max_res = 1000
+    page_count = 0
+
+    while True:
+        query = f"SELECT * FROM {entity} WHERE MetaData.LastUpdatedTime >= '{q_start}' AND MetaData.LastUpdatedTime < '{q_end}' STARTPOSITION {start_pos} MAXRESULTS {max_res}"
+        url = f"{base_url}/v3/company/{realm_id}/query?query={query}"
+
+        if fast_json:
+            # Payload stays as raw JSON text all the way to the JSONB column
+            content = fetch_with_retry(session, url, headers, logger, realm_id, requests_per_minute, raw=True, timer=timer)
+            with timer.phase('json_parse'):
+                items = decode_page(content, entity)
+        else:
+            data = fetch_with_retry(session, url, headers, logger, realm_id, requests_per_minute, timer=timer)
+            items = [(item['Id'], item) for item in data.get('QueryResponse', {}).get(entity, [])]
+
+        if not items: 
+            logger.info(f"Extraction: No items found on page {page_count + 1} (StartPos: {start_pos}). Stopping.")
+            break
+
+        page_count += 1
+        item_count = len(items)
+        # Page metrics
+        logger.info(f"Extraction: Page {page_count} retrieved {item_count} items.")
+
+        with timer.phase('record_build'):
+            records = [
+                {
+                    'realm_id': realm_id,
+                    'id': item_id,
+                    'payload': payload,
+                    'ingested_at_utc': datetime.utcnow(),
+                    'extract_window_start_utc': q_start,
+                    'extract_window_end_utc': q_end,
+                    'page_number': page_count,
+                    'request_payload': {'query': query}
+                }
+                for item_id, payload in items
+            ]
+        yield records
+
+        if len(items) < max_res: break
+        start_pos += max_res
+
+def get_raw_table(fast_json=False):
+    # Same structure and upsert as the exporter block
+    # fast_json: payload is already JSON text, Postgres coerces it into the JSONB column on insert
+    return Table(TABLE_NAME, MetaData(schema=SCHEMA),
+        Column('realm_id', String, primary_key=True),
+        Column('id', String, primary_key=True),
+        Column('payload', Text if fast_json else JSONB),
+        Column('ingested_at_utc', DateTime),
+        Column('extract_window_start_utc', DateTime),
+        Column('extract_window_end_utc', DateTime),
+        Column('page_number', Integer),
+        Column('request_payload', JSONB)
+    )
+
+def upsert_batch(engine, table, records):
+    with engine.begin() as conn:
+        stmt = insert(table).values(records)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['realm_id', 'id'],
+            set_={
+                'payload': stmt.excluded.payload,
+                'ingested_at_utc': stmt.excluded.ingested_at_utc,
+                'extract_window_start_utc': stmt.excluded.extract_window_start_utc,
+                'extract_window_end_utc': stmt.excluded.extract_window_end_utc,
+                'page_number': stmt.excluded.page_number
+            }
+        )
+        return conn.execute(stmt).rowcount
+
+class PipelinedLoader:
+    # Consumer thread upserting pages while the producer keeps fetching; the bounded queue applies backpressure
+
+    def __init__(self, logger, queue_size, batch_size, fast_json=False, timer=None):
+        self.logger = logger
+        self.timer = timer or PhaseTimer()
+        self.batch_size = batch_size
+        self.pages = queue.Queue(maxsize=queue_size)
+        self.rows_upserted = {}
+        self.error = None
+        self.aborted = False
+
+        # Phase: Database Connection
+        try:
+            pg_password = get_secret_value('POSTGRES_PASSWORD')
+            pg_user = get_secret_value('POSTGRES_USER')
+            pg_db = get_secret_value('POSTGRES_DB')
+            pg_host = get_secret_value('POSTGRES_HOST')
+            pg_port = get_secret_value('POSTGRES_PORT')
+            db_url = f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}/{pg_db}"
+
+            self.engine = create_engine(db_url)
+            self.table = get_raw_table(fast_json)
+        except Exception as e:
+            logger.error(f"Load: DB Connection failed. Error: {str(e)}")
+            raise
+
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        buffer = []
+        try:
+            while True:
+                kind, window_start, records = self.pages.get()
+                if self.aborted:
+                    return
+                if kind == 'page':
+                    buffer.extend(records)
+                # Flush full batches, and whatever is left when a window ends (batches never mix windows)
+                while len(buffer) >= self.batch_size or (buffer and kind != 'page'):
+                    batch, buffer = buffer[:self.batch_size], buffer[self.batch_size:]
+                    with self.timer.phase('upsert'):
+                        row_count = upsert_batch(self.engine, self.table, batch)
+                    self.rows_upserted[window_start] = self.rows_upserted.get(window_start, 0) + row_count
+                    self.logger.info(f"Load: Upserted batch of {len(batch)} records for window {window_start} (queue depth: {self.pages.qsize()}).")
+                if kind == 'stop':
+                    return
+        except Exception as e:
+            self.error = e
+
+    def _put(self, item):
+        # Never block forever on a full queue if the consumer has died
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def put_page(self, window_start, records):
+        self._put(('page', window_start, records))
+
+    def end_window(self, window_start):
+        self._put(('end', window_start, None))
+
+    def abort(self):
+        # Extraction failed: stop the consumer without waiting for the queue to drain
+        self.aborted = True
+        try:
+            self.pages.put_nowait(('stop', None, None))
+        except queue.Full:
+            pass
+        self.engine.dispose()
+
+    def close(self):
+        self._put(('stop', None, None))
+        self.thread.join()
+        self.engine.dispose()
+        if self.error is not None:
+            self.logger.error(f"Load: Transaction failed. Error: {str(self.error)}")
+            raise self.error
+        return self.rows_upserted
+
 # Data extractor (Dynamic Child)
 
 @data_loader
@@ -54,70 +249,142 @@ def load_chunk(chunk_data, *args, **kwargs):
     # Logging: Initialize logger
     logger = kwargs.get('logger')
     
-    start_time = time.time()
-    q_start = chunk_data['q_start']
-    q_end = chunk_data['q_end']
+    chunk_start_time = time.time()
+    realm_id = chunk_data.get('realm_id') or get_secret_value('QBO_REALM_ID')
+    requests_per_minute = int(kwargs.get('qbo_requests_per_minute', DEFAULT_REQUESTS_PER_MINUTE))
+    # Older single-window payloads carry q_start/q_end at the top level
+    windows = chunk_data.get('windows') or [chunk_data]
+    # Pipelined mode: upsert pages into Postgres while the next pages are being fetched
+    pipelined = str(kwargs.get('pipelined_load', False)).lower() in ('1', 'true', 'yes')
+    # Fast path: faster decoder, only Id extracted, payload passed through as raw JSON text
+    fast_json = str(kwargs.get('fast_json', False)).lower() in ('1', 'true', 'yes')
+    # Profiling mode: phase timers per window, optional sampling profiler per child
+    profile = str(kwargs.get('profile', False)).lower() in ('1', 'true', 'yes')
+    profile_sampler = profile and str(kwargs.get('profile_sampler', False)).lower() in ('1', 'true', 'yes')
+    timer = PhaseTimer(profile)
+    profile_dir = get_profile_dir(kwargs) if profile else None
+    profile_name = f"invoice_fetch_{realm_id}_{windows[0]['q_start']}_chunk"
     
-    logger.info(f"--- Starting Chunk {chunk_data['index']}/{chunk_data['total']}: {q_start} ---")
+    logger.info(f"--- Starting Chunk {chunk_data['index']}/{chunk_data['total']}: realm {realm_id}, {len(windows)} window(s) from {windows[0]['q_start']} ---")
     
+    # Shared resources for every window of the group
     # OAuth 2.0: Token refresh per execution/tramo
-    headers = get_auth_headers(logger)
+    headers = get_auth_headers(logger, realm_id, timer)
     
     ENTITY = "Invoice"
-    realm_id = get_secret_value('QBO_REALM_ID')
     base_url = "https://sandbox-quickbooks.api.intuit.com" if get_secret_value('QBO_ENTORNO') == 'sandbox' else "https://quickbooks.api.intuit.com"
     
     all_records = []
-    start_pos = 1
-    max_res = 1000
-    page_count = 0
+    rows_fetched = {}
+    loader = None
+    if pipelined:
+        queue_size = max(1, int(kwargs.get('load_queue_size', 4)))
+        batch_size = max(1, int(kwargs.get('load_batch_size', 1000)))
+        logger.info(f"Load: Pipelined mode enabled (queue size: {queue_size} pages, batch size: {batch_size} records).")
+        loader = PipelinedLoader(logger, queue_size, batch_size, fast_json, PhaseTimer(profile))
 
-    # Phase: Extraction
+    # Chunk-level phases (auth) are reported separately from the per-window ones
+    chunk_phases = timer.snapshot()
+
+    sampler = start_sampler(profile_sampler)
+    sampler_path = None
     try:
-        while True:
-            query = f"SELECT * FROM {ENTITY} WHERE MetaData.LastUpdatedTime >= '{q_start}' AND MetaData.LastUpdatedTime < '{q_end}' STARTPOSITION {start_pos} MAXRESULTS {max_res}"
-            url = f"{base_url}/v3/company/{realm_id}/query?query={query}"
-            
-            data = fetch_with_retry(url, headers, logger)
-            items = data.get('QueryResponse', {}).get(ENTITY, [])
-            
-            if not items: 
-                logger.info(f"Extraction: No items found on page {page_count + 1} (StartPos: {start_pos}). Stopping.")
-                break
-            
-            page_count += 1
-            item_count = len(items)
-            # Page metrics
-            logger.info(f"Extraction: Page {page_count} retrieved {item_count} items.")
-
-            for item in items:
-                all_records.append({
-                    'id': item['Id'],
-                    'payload': item,
-                    'ingested_at_utc': datetime.utcnow(),
-                    'extract_window_start_utc': q_start,
-                    'extract_window_end_utc': q_end,
-                    'page_number': page_count,
-                    'request_payload': {'query': query}
-                })
-            
-            if len(items) < max_res: break
-            start_pos += max_res
-
-    except Exception as e:
-        logger.error(f"Extraction: Critical failure in chunk {q_start}. Error: {str(e)}")
-        raise
-
-    # Validation
-    # Detect unexpected empty days (Regression Check)
-    if len(all_records) == 0:
-        logger.warning(f"Validation: [ALERT] Chunk {q_start} returned 0 records. If this date is expected to have data, this is a regression.")
-    else:
-        logger.info(f"Validation: Chunk {q_start} extraction passed volumetry check (>0 items).")
-
-    # Final metrics per chunk
-    duration = time.time() - start_time
-    logger.info(f"--- Chunk Summary: {q_start} ---")
-    logger.info(f"Metrics: {{'pages_read': {page_count}, 'rows_fetched': {len(all_records)}, 'duration_seconds': {duration:.2f}}}")
-
-    return pd.DataFrame(all_records)
\ No newline at end of file
+        with requests.Session() as session:
+            for window in windows:
+                start_time = time.time()
+                q_start = window['q_start']
+                page_count = 0
+                row_count = 0
+
+                # Phase: Extraction
+                try:
+                    for records in fetch_window_pages(session, base_url, realm_id, headers, window, logger, requests_per_minute, ENTITY, fast_json, timer):
+                        page_count += 1
+                        row_count += len(records)
+                        if loader is not None:
+                            with timer.phase('queue_put'):
+                                loader.put_page(q_start, records)
+                        else:
+                            all_records.extend(records)
+                    if loader is not None:
+                        loader.end_window(q_start)
+                except Exception as e:
+                    # A consumer failure surfaces here when the producer hands over the next page
+                    if loader is not None and e is loader.error:
+                        logger.error(f"Load: Transaction failed in chunk {realm_id} {q_start}. Error: {str(e)}")
+                    else:
+                        logger.error(f"Extraction: Critical failure in chunk {realm_id} {q_start}. Error: {str(e)}")
+                    if loader is not None:
+                        loader.abort()
+                    raise
+
+                rows_fetched[q_start] = row_count
+
+                # Validation
+                # Detect unexpected empty days (Regression Check)
+                if row_count == 0:
+                    logger.warning(f"Validation: [ALERT] Chunk {realm_id} {q_start} returned 0 records. If this date is expected to have data, this is a regression.")
+                else:
+                    logger.info(f"Validation: Chunk {realm_id} {q_start} extraction passed volumetry check (>0 items).")
+
+                # Final metrics per window
+                duration = time.time() - start_time
+                logger.info(f"--- Chunk Summary: realm {realm_id} {q_start} ---")
+                logger.info(f"Metrics: {{'pages_read': {page_count}, 'rows_fetched': {row_count}, 'duration_seconds': {duration:.2f}}}")
+
+                if profile:
+                    path = write_profile_artifact(profile_dir, f"invoice_fetch_{realm_id}_{q_start}", {
+                        'block': 'fetcher',
+                        'entity': ENTITY,
+                        'realm_id': realm_id,
+                        'window': q_start,
+                        'pages': page_count,
+                        'rows': row_count,
+                        'duration_seconds': round(duration, 6),
+                        'phases': timer.snapshot()
+                    })
+                    logger.info(f"Profile: Window profile written to {path}")
+
+        if loader is not None:
+            rows_upserted = loader.close()
+            # The consumer thread overlaps with extraction, so its time is reported at chunk level
+            for name, stats in loader.timer.snapshot().items():
+                chunk_phases[f"pipelined_{name}"] = stats
+
+            # Validation
+            # Ensure Input vs Output logic holds per window.
+            for q_start, input_count in rows_fetched.items():
+                output_count = rows_upserted.get(q_start, 0)
+                if input_count > 0 and output_count == 0:
+                    msg = f"Validation: Critical Integrity Error. Input {input_count} rows, but DB reported 0 rows affected (realm {realm_id}, window {q_start})."
+                    logger.error(msg)
+                    raise Exception(msg)
+                logger.info(f"Validation: Integrity Check Passed. Window {q_start} Input: {input_count} | Output (rows affected): {output_count}")
+    finally:
+        # Always stop the sampler, a failed child keeps its capture for inspection
+        if profile_sampler:
+            sampler_path = stop_sampler(sampler, profile_dir, profile_name)
+
+    if len(windows) > 1 or loader is not None:
+        duration = time.time() - chunk_start_time
+        logger.info(f"Metrics: {{'windows': {len(windows)}, 'rows_fetched': {sum(rows_fetched.values())}, 'duration_seconds': {duration:.2f}}}")
+
+    # In pipelined mode the rows are already in Postgres; the exporter receives an empty frame
+    with timer.phase('dataframe_build'):
+        df = pd.DataFrame(all_records)
+
+    if profile:
+        chunk_phases.update(timer.snapshot())
+        path = write_profile_artifact(profile_dir, profile_name, {
+            'block': 'fetcher',
+            'entity': ENTITY,
+            'realm_id': realm_id,
+            'window': 'chunk',
+            'windows': [w['q_start'] for w in windows],
+            'duration_seconds': round(time.time() - chunk_start_time, 6),
+            'phases': chunk_phases,
+            'sampler': sampler_path
+        })
+        logger.info(f"Profile: Chunk profile written to {path}")
+
+    return df
\ No newline at end of file
@@ -0,0 +1,100 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Optional sampling profiler (profile_sampler mode); cProfile is the fallback
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Profiling mode: per-phase timers and optional sampler, written as per-window artifacts
+DEFAULT_PROFILE_DIR = '/home/src/orchestrator/profiles'
+
+class PhaseTimer:
+    # Accumulates wall time per phase when profiling is enabled; no-op otherwise
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            total, count = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (total + seconds, count + 1)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def total(self, name):
+        return self.phases.get(name, (0.0, 0))[0]
+
+    def snapshot(self, reset=True):
+        with self.lock:
+            phases = {name: {'seconds': round(total, 6), 'count': count} for name, (total, count) in self.phases.items()}
+            if reset:
+                self.phases = {}
+        return phases
+
+def attach_db_timer(engine, timer):
+    # Pure database time (driver round trip) measured around each cursor execute
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['profile_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timer.add('db_execute', time.perf_counter() - conn.info.pop('profile_start'))
+
+def get_profile_dir(kwargs):
+    # One folder per pipeline run, shared by every child of the run
+    run = str(kwargs.get('execution_date') or 'adhoc').replace(' ', 'T').replace(':', '')
+    return os.path.join(kwargs.get('profile_dir', DEFAULT_PROFILE_DIR), str(kwargs.get('pipeline_uuid', 'adhoc')), run)
+
+def write_profile_artifact(directory, name, data):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.json")
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    return path
+
+def start_sampler(enabled):
+    if not enabled:
+        return None
+    if pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_sampler(profiler, directory, name):
+    if profiler is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = os.path.join(directory, f"{name}.prof")
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = os.path.join(directory, f"{name}.html")
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    return path
@@ -0,0 +1,50 @@
+import fcntl
+import os
+import requests
+import time
+from mage_ai.data_preparation.shared.secrets import get_secret_value
+from orchestrator.utils.profiling import PhaseTimer
+
+# Rate-limit budget per realm (QBO throttles each company separately)
+# Dynamic children run in separate processes, so the next free slot of each realm lives in a locked file
+DEFAULT_REQUESTS_PER_MINUTE = 500
+RATE_LIMIT_DIR = '/home/src/orchestrator/.rate_limit'
+
+def get_auth_headers(logger, realm_id, timer=None):
+    timer = timer or PhaseTimer()
+    # Phase: Auth
+    logger.info(f"Auth: Requesting new access token via Refresh Token for realm {realm_id}...")
+    try:
+        url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
+        # Each company has its own refresh token; fall back to the shared one for single-realm setups
+        refresh_token = get_secret_value(f'QBO_REFRESH_TOKEN_{realm_id}') or get_secret_value('QBO_REFRESH_TOKEN')
+        payload = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+        }
+        auth = (get_secret_value('QBO_CLIENT_ID'), get_secret_value('QBO_CLIENT_SECRET'))
+        with timer.phase('auth'):
+            resp = requests.post(url, data=payload, auth=auth)
+            resp.raise_for_status()
+            access_token = resp.json()["access_token"]
+        logger.info(f"Auth: Access token obtained successfully for realm {realm_id}.")
+        return {'Authorization': f'Bearer {access_token}', 'Accept': 'application/json'}
+    except Exception as e:
+        logger.error(f"Auth: Failed to retrieve token for realm {realm_id}. Error: {str(e)}")
+        raise
+
+def wait_for_realm_budget(realm_id, requests_per_minute, backoff=0):
+    # Reserve the next request slot of this realm across every child process and thread
+    # A 429 (backoff) pushes the realm's slots forward for all of them, other realms are not affected
+    os.makedirs(RATE_LIMIT_DIR, exist_ok=True)
+    fd = os.open(os.path.join(RATE_LIMIT_DIR, f"{realm_id}.slot"), os.O_RDWR | os.O_CREAT)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        now = time.time()
+        stored = f.read().strip()
+        next_slot = max(float(stored) if stored else now, now + backoff)
+        f.seek(0)
+        f.truncate()
+        f.write(str(next_slot + 60.0 / requests_per_minute))
+        f.flush()
+    time.sleep(max(0, next_slot - now))